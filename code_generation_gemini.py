@@ -1,40 +1,107 @@
 # Take the ir.json and pass it to an LLM, generate code and write to index.html
 import os
-import json
-from google import genai
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
 
-from .gemini_utils import get_api_key_from_file, has_internet, load_prompt
-from .paths import API_KEY_FILE, PROMPT_FILE, HIERARCHY_WIREFRAME_JSON, OUTPUT_HTML, DEFAULT_MODEL
+import orjson
 
+from .gemini_utils import (
+    get_client,
+    has_internet,
+    load_cached_response,
+    load_prompt,
+    make_cache_key,
+    save_cached_response,
+    throttle_status,
+)
+from .paths import API_KEY_FILE, PROMPT_FILE, HIERARCHY_WIREFRAME_JSON, OUTPUT_HTML, DEFAULT_MODEL, WRITE_BUFFER_SIZE
 
-# Main generation logic (cleanly encapsulated)
-def generate_html():
+
+# Send the request to Gemini and stream the generated HTML into out_file as it arrives.
+# Returns the full generated text (None on failure, out_file is then left untouched)
+def _request_html(contents, out_file, status_callback=None):
 
     # Check internet first
     if not has_internet():
         print("No internet connection. Cannot generate HTML.")
-        return
-
-    # Load API key
-    key = get_api_key_from_file(API_KEY_FILE)
-    if not key:
-        return
-
-    os.environ['GEMINI_API_KEY'] = key
+        return None
 
-    # Initialize Gemini client
+    # Initialize Gemini client (reused across calls)
     try:
-        client = genai.Client()
+        client = get_client(API_KEY_FILE)
     except Exception as e:
         print("Failed to initialize Gemini client:", e)
-        return
+        return None
 
-    # Load layout JSON
+    # Send request to Gemini, writing chunks to a temp file that replaces out_file at the end
+    progress = throttle_status(status_callback)
+    tmp_file = f"{out_file}.tmp"
+    parts = []
+    written = 0
     try:
-        with open(str(HIERARCHY_WIREFRAME_JSON), "r", encoding="utf-8") as f:
-            layout_json = json.load(f)
-    except Exception as e:
-        print("Failed to read layout JSON:", e)
+        try:
+            with open(tmp_file, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                for chunk in client.models.generate_content_stream(
+                    model=DEFAULT_MODEL,
+                    contents=contents,
+                ):
+                    if not chunk.text:
+                        continue
+                    data = chunk.text.encode("utf-8")
+                    f.write(data)
+                    parts.append(chunk.text)
+                    written += len(data)
+                    if progress:
+                        progress(f"Generating HTML... {written} bytes received")
+        except Exception as e:
+            print("Error during API call:", e)
+            return None
+
+        if not parts:
+            print("Model returned empty output.")
+            return None
+
+        try:
+            os.replace(tmp_file, out_file)
+        except Exception as e:
+            print("Failed to write HTML:", e)
+            return None
+    finally:
+        # Gone after a successful replace; otherwise don't leave a partial file behind
+        try:
+            os.unlink(tmp_file)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("Failed to remove temporary HTML file:", e)
+
+    return "".join(parts)
+
+
+# Main generation logic (cleanly encapsulated)
+# tree: the result of process_wireframe_json() when called in-process; otherwise read from disk
+# use_cache: reuse the cached response for an identical request (False always asks Gemini again)
+def generate_html(
+    status_callback: Optional[Callable[[str], None]] = None,
+    tree: Optional[Dict[str, Any]] = None,
+    use_cache: bool = True,
+):
+
+    if tree is not None:
+        # Serialized exactly like the file json_hierarchy writes (same request, same cache key)
+        layout_str = orjson.dumps(tree, option=orjson.OPT_INDENT_2).decode("utf-8")
+    else:
+        # Load layout JSON (already serialized by json_hierarchy, so it's sent as-is)
+        try:
+            with open(str(HIERARCHY_WIREFRAME_JSON), "r", encoding="utf-8") as f:
+                layout_str = f.read()
+        except Exception as e:
+            print("Failed to read layout JSON:", e)
+            return
+
+    if not layout_str.strip():
+        print("Layout JSON is empty. Run the hierarchy step first.")
         return
 
     # Load prompt
@@ -44,29 +111,134 @@ def generate_html():
         return
 
     # Prepare contents
-    layout_str = json.dumps(layout_json, indent=2)
     contents = [prompt, layout_str]
 
-    # Send request to Gemini
+    # Reuse the previous response for an identical request
+    cache_key = make_cache_key(DEFAULT_MODEL, prompt, layout_str)
+    generated_html = load_cached_response(cache_key) if use_cache else None
+    if generated_html is None:
+        # Streams straight into OUTPUT_HTML
+        generated_html = _request_html(contents, str(OUTPUT_HTML), status_callback)
+        if generated_html is None:
+            return
+        save_cached_response(cache_key, generated_html)
+    else:
+        print("Using cached Gemini response.")
+
+        # Save output HTML
+        try:
+            with open(str(OUTPUT_HTML), "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                f.write(generated_html.encode("utf-8"))
+        except Exception as e:
+            print("Failed to write HTML:", e)
+
+    return f"HTML saved to {str(OUTPUT_HTML)}"
+
+
+# Batch API job states after which polling stops
+_BATCH_DONE_STATES = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+BATCH_POLL_INTERVAL = 10  # seconds
+# Batch jobs can take up to 24h to be scheduled; give up waiting after this long
+BATCH_TIMEOUT = 15 * 60  # seconds
+
+
+# Submit all requests as one Gemini Batch API job and wait (at most timeout seconds) for it to finish.
+# Returns one text per request, or None if the Batch API could not be used or took too long.
+def _generate_batch(client, contents_list, timeout=BATCH_TIMEOUT):
     try:
-        response = client.models.generate_content(
+        job = client.batches.create(
             model=DEFAULT_MODEL,
-            contents=contents,
+            src=[
+                {"contents": [{"role": "user", "parts": [{"text": part} for part in contents]}]}
+                for contents in contents_list
+            ],
         )
+        deadline = time.monotonic() + timeout
+        while job.state.name not in _BATCH_DONE_STATES:
+            if time.monotonic() >= deadline:
+                print(f"Batch job not done after {timeout}s, sending requests individually.")
+                try:
+                    client.batches.cancel(name=job.name)
+                except Exception as e:
+                    print("Failed to cancel batch job:", e)
+                return None
+            time.sleep(BATCH_POLL_INTERVAL)
+            job = client.batches.get(name=job.name)
     except Exception as e:
-        print("Error during API call:", e)
-        return
+        print("Batch API unavailable, sending requests individually:", e)
+        return None
+
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        print(f"Batch job finished with state {job.state.name}, sending requests individually.")
+        return None
+
+    return [r.response.text if r.response else None for r in job.dest.inlined_responses]
+
+
+# Send the requests concurrently over the shared client (one text or None per request)
+def _generate_concurrently(client, contents_list):
+    def _one(contents):
+        try:
+            return client.models.generate_content(model=DEFAULT_MODEL, contents=contents).text
+        except Exception as e:
+            print("Error during API call:", e)
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(8, len(contents_list))) as pool:
+        return list(pool.map(_one, contents_list))
+
+
+def generate_html_many(
+    layouts: List[Dict[str, Any]],
+    use_batch_api: bool = True,
+    use_cache: bool = True,
+    batch_timeout: float = BATCH_TIMEOUT,
+) -> List[Optional[str]]:
+    """
+    Generate HTML for several layouts (e.g. multiple sketches) in one go.
+    Cached responses are reused (unless use_cache is False); the rest are sent as a
+    single Gemini Batch API job (cheaper, but may take a while to be scheduled) or,
+    if that is unavailable, not done within batch_timeout seconds (the job is then
+    cancelled) or use_batch_api is False, as concurrent requests.
+    Returns one HTML string per layout, in order (None where generation failed).
+    """
+    results: List[Optional[str]] = [None] * len(layouts)
+
+    prompt = load_prompt(str(PROMPT_FILE))
+    if not prompt.strip():
+        print("Prompt is empty. Check prompt.txt.")
+        return results
+
+    layout_strs = [orjson.dumps(layout, option=orjson.OPT_INDENT_2).decode("utf-8") for layout in layouts]
+    cache_keys = [make_cache_key(DEFAULT_MODEL, prompt, s) for s in layout_strs]
+    if use_cache:
+        results = [load_cached_response(key) for key in cache_keys]
 
-    generated_html = response.text
+    pending = [i for i, html in enumerate(results) if html is None]
+    if not pending:
+        return results
+
+    if not has_internet():
+        print("No internet connection. Cannot generate HTML.")
+        return results
 
-    # Save output HTML
     try:
-        with open(str(OUTPUT_HTML), "w", encoding="utf-8") as f:
-            f.write(generated_html)
+        client = get_client(API_KEY_FILE)
     except Exception as e:
-        print("Failed to write HTML:", e)
+        print("Failed to initialize Gemini client:", e)
+        return results
 
-    return f"HTML saved to {str(OUTPUT_HTML)}"
+    contents_list = [[prompt, layout_strs[i]] for i in pending]
+    texts = _generate_batch(client, contents_list, batch_timeout) if use_batch_api else None
+    if texts is None:
+        texts = _generate_concurrently(client, contents_list)
+
+    for i, html in zip(pending, texts):
+        if html:
+            results[i] = html
+            save_cached_response(cache_keys[i], html)
+
+    return results
 
 
 # Script entry point
@@ -3,16 +3,28 @@ Feedback engine for SketchToCode.
 
 - Backwards compatible CLI: when run as a script it reads USER_PROMPT and writes to files/index.html.
 - Callable from GUI: apply_feedback(user_prompt_text=..., html_file=...)
+- Async: apply_feedback_async(...) / apply_feedback_many([...]) for several concurrent requests
 """
 
+import asyncio
 import os
 import re
-from typing import Callable, Optional
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
-from google import genai
+from .gemini_utils import (
+    get_client,
+    load_cached_response,
+    load_prompt,
+    make_cache_key,
+    read_text_file,
+    save_cached_response,
+    throttle_status,
+)
+from .paths import API_KEY_FILE, FEEDBACK_PROMPT_FILE, USER_PROMPT_FILE, DEFAULT_HTML_FILE, DEFAULT_MODEL, WRITE_BUFFER_SIZE
 
-from .gemini_utils import get_api_key_from_file, load_prompt
-from .paths import API_KEY_FILE, FEEDBACK_PROMPT_FILE, USER_PROMPT_FILE, DEFAULT_HTML_FILE, DEFAULT_MODEL
+
+# Opening fence of an html block (```html, ```HTML, ...)
+_HTML_FENCE_RE = re.compile(r"```html", re.I)
 
 
 def _extract_html_from_model_output(text: str) -> str:
@@ -23,64 +35,60 @@ def _extract_html_from_model_output(text: str) -> str:
     if not text:
         return ""
 
-    # Try to find ```html ... ```
-    m = re.search(r"```html\s*(.*?)```", text, flags=re.S | re.I)
+    # Try to find ```html ... ``` (plain substring search for the closing fence,
+    # no backtracking over large outputs)
+    m = _HTML_FENCE_RE.search(text)
     if m:
-        return m.group(1).strip()
+        end = text.find("```", m.end())
+        if end != -1:
+            return text[m.end():end].strip()
 
-    # Try any fenced block
-    m2 = re.search(r"```(?:[^\n]*)\n(.*?)```", text, flags=re.S)
-    if m2:
-        return m2.group(1).strip()
+    # Try any fenced block: ```<info line>\n ... ```
+    start = text.find("```")
+    if start != -1:
+        body_start = text.find("\n", start + 3) + 1
+        if body_start:
+            end = text.find("```", body_start)
+            if end != -1:
+                return text[body_start:end].strip()
 
     # fallback: return whole text
     return text.strip()
 
 
-def apply_feedback(
-    user_prompt_text: Optional[str] = None,
-    html_file: Optional[str] = None,
-    api_key_file: str = str(API_KEY_FILE),
-    prompt_file: str = str(FEEDBACK_PROMPT_FILE),
-    model: str = DEFAULT_MODEL,
-) -> str:
+def _join_feedback(user_prompt_texts: Sequence[str]) -> str:
     """
-    Apply user feedback to HTML.
+    Combine several edit requests into one numbered feedback block,
+    so they can be applied with a single Gemini call.
+    """
+    edits = [t.strip() for t in user_prompt_texts if t and t.strip()]
+    if len(edits) == 1:
+        return edits[0]
+    return "\n\n".join(f"EDIT {i}:\n{edit}" for i, edit in enumerate(edits, start=1))
 
-    Args:
-      user_prompt_text: If provided, use this; otherwise fallback to USER_PROMPT file.
-      html_file: Path to the HTML file to read & overwrite. Defaults to files/index.html.
-      api_key_file: Path to API key file (default gemini_key.txt).
-      prompt_file: Path to base prompt (default feedback_prompt.txt).
-      model: Gemini model to use.
 
-    Returns:
-      A status string similar to earlier CLI behavior (errors prefixed with [ERROR], warnings with [WARN]).
+def _build_feedback_prompt(
+    user_prompt_text: Union[str, Sequence[str], None],
+    html_file: str,
+    prompt_file: str,
+) -> Tuple[Optional[str], Optional[str]]:
     """
-    html_file = html_file or DEFAULT_HTML_FILE
+    Build the full prompt (base prompt + user feedback + current HTML).
 
+    Returns:
+      (full_prompt, None) on success, or (None, status) when there is nothing to send.
+    """
     # Determine prompt (preserve CLI fallback behavior)
     if user_prompt_text is None:
         # CLI-style behavior: read USER_PROMPT file as fallback
-        user_prompt_text = load_prompt(str(USER_PROMPT_FILE)).strip()
-
-    print("Feedback engine: loading API key...")
-    key = get_api_key_from_file(api_key_file)
-    if not key:
-        return "[ERROR] No API Key found (gemini_key.txt)."
-
-    os.environ["GEMINI_API_KEY"] = key
-
-    print("Feedback engine: initializing Gemini client...")
-    try:
-        client = genai.Client()
-    except Exception as e:
-        return f"[ERROR] Failed to initialize Gemini client: {e}"
+        user_prompt_text = read_text_file(str(USER_PROMPT_FILE)).strip()
+    elif not isinstance(user_prompt_text, str):
+        user_prompt_text = _join_feedback(user_prompt_text)
 
     print(f"Feedback engine: reading HTML file: {html_file}")
-    html_content = load_prompt(html_file)
+    html_content = read_text_file(html_file)
     if not html_content.strip():
-        return "[WARN] HTML file missing or empty. Nothing to apply feedback on."
+        return None, "[WARN] HTML file missing or empty. Nothing to apply feedback on."
 
     print("Feedback engine: loading base prompt (if present)...")
     base_prompt = load_prompt(prompt_file).strip()
@@ -102,23 +110,67 @@ def apply_feedback(
         "```"
     )
 
-    full_prompt = "\n\n---\n\n".join(sections)
+    return "\n\n---\n\n".join(sections), None
 
-    print("Feedback engine: sending request to Gemini...")
-    try:
-        response = client.models.generate_content(
-            model=model,
-            contents=full_prompt,
-        )
-    except Exception as e:
-        return f"[ERROR] Error during API call: {e}"
 
-    # Extract generated HTML (try to be tolerant of fenced code)
+def _load_client(api_key_file: str):
+    """
+    Returns (client, None) on success or (None, error status).
+    """
+    print("Feedback engine: initializing Gemini client...")
     try:
-        generated_html_raw = response.text
+        return get_client(api_key_file), None
+    except ValueError:
+        return None, "[ERROR] No API Key found (gemini_key.txt)."
     except Exception as e:
-        return f"[ERROR] Failed to extract text from response: {e}"
+        return None, f"[ERROR] Failed to initialize Gemini client: {e}"
+
+
+def _collect_chunk(chunk, parts: List[str], status_callback: Optional[Callable[[str], None]]) -> None:
+    """
+    Append the text of one streamed response chunk and report progress.
+    """
+    if not chunk.text:
+        return
+    parts.append(chunk.text)
+    if status_callback:
+        status_callback(f"Receiving HTML... ({len(parts)} chunks)")
+
+
+def _start_feedback(
+    user_prompt_text: Union[str, Sequence[str], None],
+    html_file: str,
+    prompt_file: str,
+    model: str,
+    use_cache: bool,
+) -> Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]:
+    """
+    Shared first half of apply_feedback() / apply_feedback_async():
+    build the prompt and look up a cached response.
+
+    Returns:
+      (full_prompt, cache_key, cached_raw, None), where cached_raw is None on a cache miss,
+      or (None, None, None, status) when there is nothing to send.
+    """
+    full_prompt, status = _build_feedback_prompt(user_prompt_text, html_file, prompt_file)
+    if full_prompt is None:
+        return None, None, None, status
+
+    # Reuse the previous response for an identical request
+    cache_key = make_cache_key(model, full_prompt)
+    cached_raw = load_cached_response(cache_key) if use_cache else None
+    if cached_raw is not None:
+        print("Feedback engine: using cached Gemini response.")
+    return full_prompt, cache_key, cached_raw, None
 
+
+def _finish_feedback(generated_html_raw: str, html_file: str, cache_key: Optional[str] = None) -> str:
+    """
+    Shared second half of apply_feedback() / apply_feedback_async():
+    extract the HTML from the model output and overwrite html_file with it.
+    With a cache_key (fresh response), the raw output is cached once it is known to contain HTML.
+    Returns the final status string.
+    """
     if not generated_html_raw or not generated_html_raw.strip():
         return "[WARN] Model returned empty output. HTML file not modified."
 
@@ -127,10 +179,13 @@ def apply_feedback(
     if not new_html.strip():
         return "[WARN] Model returned no HTML after extraction."
 
+    if cache_key:
+        save_cached_response(cache_key, generated_html_raw)
+
     print(f"Feedback engine: writing HTML to {html_file} ...")
     try:
-        with open(html_file, "w", encoding="utf-8") as f:
-            f.write(new_html)
+        with open(html_file, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(new_html.encode("utf-8"))
     except Exception as e:
         return f"[ERROR] Failed to write HTML file: {e}"
 
@@ -139,9 +194,150 @@ def apply_feedback(
     return success_msg
 
 
+def apply_feedback(
+    user_prompt_text: Union[str, Sequence[str], None] = None,
+    html_file: Optional[str] = None,
+    api_key_file: str = str(API_KEY_FILE),
+    prompt_file: str = str(FEEDBACK_PROMPT_FILE),
+    model: str = DEFAULT_MODEL,
+    status_callback: Optional[Callable[[str], None]] = None,
+    use_cache: bool = True,
+) -> str:
+    """
+    Apply user feedback to HTML.
+
+    Args:
+      user_prompt_text: If provided, use this; otherwise fallback to USER_PROMPT file.
+                        A list of edit requests is sent as one numbered request.
+      html_file: Path to the HTML file to read & overwrite. Defaults to files/index.html.
+      api_key_file: Path to API key file (default gemini_key.txt).
+      prompt_file: Path to base prompt (default feedback_prompt.txt).
+      model: Gemini model to use.
+      status_callback: Optional callable receiving progress messages while the response streams in.
+      use_cache: Reuse the cached response for an identical request (False always asks Gemini again).
+
+    Returns:
+      A status string similar to earlier CLI behavior (errors prefixed with [ERROR], warnings with [WARN]).
+    """
+    html_file = html_file or DEFAULT_HTML_FILE
+
+    full_prompt, cache_key, cached_raw, status = _start_feedback(
+        user_prompt_text, html_file, prompt_file, model, use_cache
+    )
+    if full_prompt is None:
+        return status
+    if cached_raw is not None:
+        return _finish_feedback(cached_raw, html_file)
+
+    client, status = _load_client(api_key_file)
+    if client is None:
+        return status
+
+    print("Feedback engine: sending request to Gemini...")
+    progress = throttle_status(status_callback)
+    parts = []
+    try:
+        for chunk in client.models.generate_content_stream(
+            model=model,
+            contents=full_prompt,
+        ):
+            _collect_chunk(chunk, parts, progress)
+    except Exception as e:
+        return f"[ERROR] Error during API call: {e}"
+
+    return _finish_feedback("".join(parts), html_file, cache_key)
+
+
+async def apply_feedback_async(
+    user_prompt_text: Union[str, Sequence[str], None] = None,
+    html_file: Optional[str] = None,
+    api_key_file: str = str(API_KEY_FILE),
+    prompt_file: str = str(FEEDBACK_PROMPT_FILE),
+    model: str = DEFAULT_MODEL,
+    status_callback: Optional[Callable[[str], None]] = None,
+    use_cache: bool = True,
+) -> str:
+    """
+    Same as apply_feedback(), but awaits the Gemini call through the async client
+    so several feedback requests can be in flight at once.
+    """
+    html_file = html_file or DEFAULT_HTML_FILE
+
+    full_prompt, cache_key, cached_raw, status = _start_feedback(
+        user_prompt_text, html_file, prompt_file, model, use_cache
+    )
+    if full_prompt is None:
+        return status
+    if cached_raw is not None:
+        return _finish_feedback(cached_raw, html_file)
+
+    client, status = _load_client(api_key_file)
+    if client is None:
+        return status
+
+    print("Feedback engine: sending request to Gemini...")
+    progress = throttle_status(status_callback)
+    parts = []
+    try:
+        async for chunk in await client.aio.models.generate_content_stream(
+            model=model,
+            contents=full_prompt,
+        ):
+            _collect_chunk(chunk, parts, progress)
+    except Exception as e:
+        return f"[ERROR] Error during API call: {e}"
+
+    return _finish_feedback("".join(parts), html_file, cache_key)
+
+
+async def apply_feedback_many(
+    inputs: Sequence[Dict[str, Any]],
+    max_concurrency: int = 4,
+) -> List[str]:
+    """
+    Apply several feedback requests concurrently.
+
+    Args:
+      inputs: One dict of apply_feedback() keyword arguments per request
+              (e.g. {"user_prompt_text": ..., "html_file": ...}).
+      max_concurrency: Maximum number of Gemini requests in flight at once
+                       (keep it within the API rate limit).
+
+    Each input must target a different html_file: concurrent edits of the same file would
+    overwrite each other. Only the first input for a file is applied; later ones get an
+    [ERROR] status (pass their edits together as a list in one input instead).
+
+    Returns:
+      One status string per input, in the same order.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _run(kwargs: Dict[str, Any]) -> str:
+        async with semaphore:
+            return await apply_feedback_async(**kwargs)
+
+    async def _reject(html_file: str) -> str:
+        return (
+            f"[ERROR] Another request in this batch already edits {html_file}; "
+            "combine the edits into one request (a list of prompts)."
+        )
+
+    seen_files = set()
+    tasks = []
+    for kwargs in inputs:
+        html_file = os.path.abspath(kwargs.get("html_file") or DEFAULT_HTML_FILE)
+        if html_file in seen_files:
+            tasks.append(_reject(html_file))
+        else:
+            seen_files.add(html_file)
+            tasks.append(_run(kwargs))
+
+    return list(await asyncio.gather(*tasks))
+
+
 # Backwards-compatible CLI entry point
 if __name__ == "__main__":
     # Use the user prompt file like your original script
-    user_prompt_cli = load_prompt(str(USER_PROMPT_FILE)).strip()
+    user_prompt_cli = read_text_file(str(USER_PROMPT_FILE)).strip()
     status = apply_feedback(user_prompt_cli)
     print(status)
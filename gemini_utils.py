@@ -1,17 +1,45 @@
 # Gemini helper functions
 
+import hashlib
+import json
+import os
 import socket
+import threading
+import time
+from functools import lru_cache
+from typing import Callable, Optional
 
+from google import genai
 
-# Helper: check internet access
+from .paths import LLM_CACHE_DIR, WRITE_BUFFER_SIZE
+
+
+# How long (seconds) a successful internet check is trusted before probing again
+INTERNET_CHECK_TTL = 30.0
+_last_online_at = None
+
+
+# Minimum time (seconds) between two streaming progress messages sent to a status callback
+STATUS_UPDATE_INTERVAL = 0.05
+
+
+# Helper: check internet access (a recent successful probe is reused)
 def has_internet(timeout=3):
-    try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect(("8.8.8.8", 53))
+    global _last_online_at
+
+    now = time.monotonic()
+    if _last_online_at is not None and now - _last_online_at < INTERNET_CHECK_TTL:
         return True
+
+    try:
+        with socket.create_connection(("8.8.8.8", 53), timeout=timeout):
+            pass
     except Exception:
         return False
 
+    _last_online_at = now
+    return True
+
 
 # Helper: read API key
 def get_api_key_from_file(filepath):
@@ -26,8 +54,60 @@ def get_api_key_from_file(filepath):
         return None
     
 
-# Helper: read external prompt
+# Helper: Gemini client, created once per API key file and reused afterwards
+def get_client(api_key_file) -> genai.Client:
+    return _create_client(str(api_key_file))
+
+
+@lru_cache(maxsize=1)
+def _create_client(api_key_file: str) -> genai.Client:
+    # Raising (instead of returning None) keeps failures out of the cache
+    key = get_api_key_from_file(api_key_file)
+    if not key:
+        raise ValueError(f"No API key found in {api_key_file}")
+
+    os.environ['GEMINI_API_KEY'] = key
+    return genai.Client()
+
+
+# Helper: create the client and open its connection in a background thread,
+# so the first real request does not pay for the TLS handshake
+def prewarm_client(api_key_file) -> threading.Thread:
+    def _warm():
+        try:
+            get_client(api_key_file).models.list()
+        except Exception as e:
+            print(f"[WARN] Failed to prewarm Gemini client: {e}")
+
+    thread = threading.Thread(target=_warm, daemon=True)
+    thread.start()
+    return thread
+
+
+# Helper: read external prompt (memoized; only for the static prompt files, e.g.
+# prompt.txt / feedback_prompt.txt, use read_text_file() for files that change)
 def load_prompt(filepath: str) -> str:
+    try:
+        st = os.stat(filepath)
+        return _read_text(str(filepath), st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        return ""
+    except Exception as e:
+        print(f"[ERROR] Failed to read file '{filepath}': {e}")
+        return ""
+
+
+# The file's mtime and size are part of the cache key, so edits are picked up
+@lru_cache(maxsize=8)
+def _read_text(filepath: str, mtime_ns: int, size: int) -> str:
+    with open(filepath, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+# Helper: read a text file that may be rewritten between calls (HTML being edited,
+# user prompt); always read from disk, since a same-size rewrite within the
+# filesystem's mtime resolution would look unchanged to load_prompt()
+def read_text_file(filepath: str) -> str:
     try:
         with open(filepath, "r", encoding="utf-8") as f:
             return f.read()
@@ -36,3 +116,55 @@ def load_prompt(filepath: str) -> str:
     except Exception as e:
         print(f"[ERROR] Failed to read file '{filepath}': {e}")
         return ""
+
+
+# Helper: build a cache key for a Gemini request
+def make_cache_key(model: str, *parts: str) -> str:
+    payload = json.dumps({"model": model, "parts": parts}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# Helper: read a cached Gemini response (None on miss)
+def load_cached_response(key: str) -> Optional[str]:
+    try:
+        with open(LLM_CACHE_DIR / f"{key}.html", "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"[WARN] Failed to read cached response: {e}")
+        return None
+
+
+# Helper: store a Gemini response in the cache
+def save_cached_response(key: str, text: str) -> None:
+    cache_file = LLM_CACHE_DIR / f"{key}.html"
+    tmp_file = cache_file.with_suffix(".tmp")
+    try:
+        LLM_CACHE_DIR.mkdir(exist_ok=True)
+        with open(tmp_file, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(text.encode("utf-8"))
+        os.replace(tmp_file, cache_file)
+    except Exception as e:
+        print(f"[WARN] Failed to write cached response: {e}")
+
+
+# Helper: wrap a status callback so a burst of progress messages (one per streamed
+# chunk) reaches it at most once per interval; None stays None
+def throttle_status(
+    status_callback: Optional[Callable[[str], None]],
+    interval: float = STATUS_UPDATE_INTERVAL,
+) -> Optional[Callable[[str], None]]:
+    if status_callback is None:
+        return None
+
+    last_sent = None
+
+    def _throttled(message: str) -> None:
+        nonlocal last_sent
+        now = time.monotonic()
+        if last_sent is None or now - last_sent >= interval:
+            last_sent = now
+            status_callback(message)
+
+    return _throttled
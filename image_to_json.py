@@ -17,28 +17,86 @@ hf_logging.set_verbosity_error()
 
 import cv2
 import numpy as np
+import torch
 import easyocr
-from PIL import Image
 from transformers import TrOCRProcessor, VisionEncoderDecoderModel
-import json
-import os
+import orjson
+import hashlib
+import importlib.util
+
+from .ocr_service import request_detection, start_service
+from .paths import FILES_DIR, OCR_CACHE_DIR, RAW_WIREFRAME_JSON, TROCR_ONNX_DIR, WRITE_BUFFER_SIZE
 
-from .paths import FILES_DIR, RAW_WIREFRAME_JSON
+TROCR_MODEL_NAME = "microsoft/trocr-base-handwritten"
 
 # Global variables for the TrOCR model to avoid reloading for every call
 trocr_processor = None
 trocr_model = None
+trocr_device = "cpu"
+trocr_dtype = torch.float32
+# Processor normalization folded into one multiply-subtract: (x / 255 - mean) / std == x * scale - shift
+trocr_pixel_scale = None
+trocr_pixel_shift = None
 
 # Global EasyOCR reader so we don't reload the model every time
 _easyocr_reader = None
 
+# Kernel used to close gaps in box outlines. A full rectangle lets OpenCV
+# run the closing as separable row/column passes.
+CLOSE_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (11, 11))
+
+# EasyOCR readings at or above this confidence are used as-is (TrOCR is skipped)
+EASYOCR_CONF_THRESHOLD = 0.85
+
+# Decode cap for TrOCR (UI labels are short)
+TROCR_MAX_NEW_TOKENS = 24
+
+# Bump when the detection logic changes, so cached OCR results are recomputed
+OCR_CACHE_VERSION = 1
+
+
+def load_trocr_onnx():
+    """
+    Returns TrOCR exported to ONNX with int8 dynamic quantization, run by ONNX Runtime on CPU.
+    The export + quantization happens once and is cached in TROCR_ONNX_DIR.
+    Returns None if optimum/onnxruntime are not installed or the export fails.
+    """
+    try:
+        from onnxruntime import SessionOptions
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        from optimum.onnxruntime import ORTModelForVision2Seq
+    except ImportError:
+        return None
+
+    try:
+        if not TROCR_ONNX_DIR.exists():
+            print("Exporting TrOCR to ONNX (first run only)...")
+            export_dir = TROCR_ONNX_DIR.with_name(TROCR_ONNX_DIR.name + ".tmp")
+            ORTModelForVision2Seq.from_pretrained(TROCR_MODEL_NAME, export=True).save_pretrained(export_dir)
+            for onnx_file in export_dir.glob("*.onnx"):
+                quantized_file = onnx_file.with_suffix(".int8")
+                quantize_dynamic(onnx_file, quantized_file, weight_type=QuantType.QInt8)
+                os.replace(quantized_file, onnx_file)
+            os.replace(export_dir, TROCR_ONNX_DIR)
+
+        session_options = SessionOptions()
+        session_options.intra_op_num_threads = os.cpu_count() or 0
+        return ORTModelForVision2Seq.from_pretrained(
+            TROCR_ONNX_DIR,
+            provider="CPUExecutionProvider",
+            session_options=session_options
+        )
+    except Exception as e:
+        print(f"ONNX TrOCR unavailable, falling back to PyTorch: {e}")
+        return None
+
 
 def get_trocr_model():
     """
     Returns cached TrOCR processor + model.
     Loads only once.
     """
-    global trocr_processor, trocr_model
+    global trocr_processor, trocr_model, trocr_device, trocr_dtype, trocr_pixel_scale, trocr_pixel_shift
 
     # EARLY RETURN if already loaded
     if trocr_processor is not None and trocr_model is not None:
@@ -47,12 +105,29 @@ def get_trocr_model():
     # Otherwise load
     try:
         print("Loading TrOCR model...")
-        trocr_processor = TrOCRProcessor.from_pretrained("microsoft/trocr-base-handwritten")
-        trocr_model = VisionEncoderDecoderModel.from_pretrained(
-            "microsoft/trocr-base-handwritten",
-            ignore_mismatched_sizes=True
-        )
-        print("TrOCR model loaded.")
+        trocr_processor = TrOCRProcessor.from_pretrained(TROCR_MODEL_NAME)
+
+        if torch.cuda.is_available():
+            # GPU: PyTorch in half precision
+            trocr_device, trocr_dtype = "cuda", torch.float16
+            trocr_model = VisionEncoderDecoderModel.from_pretrained(
+                TROCR_MODEL_NAME,
+                ignore_mismatched_sizes=True
+            ).half().to(trocr_device)
+        else:
+            # CPU: int8 ONNX Runtime model if available, otherwise FP32 PyTorch
+            trocr_device, trocr_dtype = "cpu", torch.float32
+            trocr_model = load_trocr_onnx() or VisionEncoderDecoderModel.from_pretrained(
+                TROCR_MODEL_NAME,
+                ignore_mismatched_sizes=True
+            )
+
+        image_processor = trocr_processor.image_processor
+        mean = torch.tensor(image_processor.image_mean).view(1, 3, 1, 1)
+        std = torch.tensor(image_processor.image_std).view(1, 3, 1, 1)
+        trocr_pixel_scale = (1.0 / (255.0 * std)).to(trocr_device, trocr_dtype)
+        trocr_pixel_shift = (mean / std).to(trocr_device, trocr_dtype)
+        print(f"TrOCR model loaded ({type(trocr_model).__name__} on {trocr_device}).")
     except Exception as e:
         print(f"Error loading TrOCR model: {e}")
         trocr_processor = None
@@ -77,7 +152,8 @@ def get_easyocr_reader(langs=None):
 
     try:
         print("Loading EasyOCR model...")
-        _easyocr_reader = easyocr.Reader(langs)
+        # Same CUDA device as TrOCR when one is available
+        _easyocr_reader = easyocr.Reader(langs, gpu=torch.cuda.is_available())
         print("EasyOCR reader loaded.")
     except Exception as e:
         print(f"Error loading EasyOCR model: {e}")
@@ -107,85 +183,116 @@ def initialize_models():
     print("--- Model Initialization Complete ---\n")
 
 
-def detect_text_boxes_easyocr(image_path):
+def detect_text_boxes_easyocr(image_rgb):
     """
-    Detect text boxes in a single image using a shared EasyOCR reader.
-    Returns a list of dicts: {'x', 'y', 'w', 'h'}.
+    Detect text boxes in an already decoded RGB image using a shared EasyOCR reader.
+    Returns a list of dicts: {'x', 'y', 'w', 'h', 'text', 'conf'}
+    (EasyOCR's own reading of the box and its confidence), clipped to the image,
+    or None if EasyOCR is unavailable or failed.
     """
     reader = get_easyocr_reader()
     if reader is None:
-        return []
+        return None
 
     try:
-        results = reader.readtext(image_path, detail=1)
+        results = reader.readtext(image_rgb, detail=1)
     except Exception as e:
         print(f"Error during EasyOCR detection: {e}")
-        return []
+        return None
 
+    img_h, img_w = image_rgb.shape[:2]
     text_boxes = []
-    for (bbox_points, _, _) in results:
+    for (bbox_points, text, conf) in results:
         x_coords = [p[0] for p in bbox_points]
         y_coords = [p[1] for p in bbox_points]
         
-        x = int(min(x_coords))
-        y = int(min(y_coords))
-        w = int(max(x_coords) - x)
-        h = int(max(y_coords) - y)
+        x = max(int(min(x_coords)), 0)
+        y = max(int(min(y_coords)), 0)
+        w = int(min(max(x_coords), img_w) - x)
+        h = int(min(max(y_coords), img_h) - y)
 
-        text_boxes.append({'x': x, 'y': y, 'w': w, 'h': h})
+        text_boxes.append({'x': x, 'y': y, 'w': w, 'h': h, 'text': text, 'conf': float(conf)})
     return text_boxes
 
 
-def recognize_text_with_trocr(image_path, text_box_list):
+def _trocr_read_boxes(image_rgb, boxes):
+    """
+    Run TrOCR over the given boxes of an RGB image in a single batch.
+    Returns one string per box, or None if TrOCR is unavailable.
+    """
     processor, model = get_trocr_model()
     if processor is None or model is None:
-        return []
-
-    try:
-        img = Image.open(image_path).convert("RGB")
-    except Exception as e:
-        print(f"Error opening image: {e}")
-        return []
-
-    # Collect all valid crops
-    crops = []
-    valid_boxes = []
-
-    for box in text_box_list:
-        x, y, w, h = box['x'], box['y'], box['w'], box['h']
-        if w <= 0 or h <= 0:
-            continue
-
-        cropped_img = img.crop((x, y, x + w, y + h))
-        crops.append(cropped_img)
-        valid_boxes.append(box)
-
-    if not crops:
-        return []
-
-    # Batch encode all crops at once
-    pixel_values = processor(
-        images=crops,
-        return_tensors="pt"
-    ).pixel_values
-
-    # Faster generation settings (tweakable)
-    generated_ids = model.generate(
-        pixel_values,
-        max_new_tokens=32,
-        num_beams=1
-    )
+        return None
+
+    # Resize each crop (a NumPy view into the decoded image) to the model's input
+    # size with OpenCV, instead of the processor's per-image PIL resize
+    size = processor.image_processor.size
+    batch = np.stack([
+        cv2.resize(
+            image_rgb[box['y']:box['y'] + box['h'], box['x']:box['x'] + box['w']],
+            (size["width"], size["height"]),
+            interpolation=cv2.INTER_LINEAR
+        )
+        for box in boxes
+    ])
+
+    # uint8 NHWC -> NCHW, moved to the model's device, then normalized in place
+    pixel_values = torch.from_numpy(batch).permute(0, 3, 1, 2)
+    if trocr_device == "cuda":
+        # Pinned host memory lets the host-to-GPU copy run asynchronously
+        pixel_values = pixel_values.pin_memory()
+    pixel_values = pixel_values.to(trocr_device, non_blocking=True).to(trocr_dtype)
+    pixel_values.mul_(trocr_pixel_scale).sub_(trocr_pixel_shift)
+
+    # Faster generation settings (tweakable): greedy decoding, short UI labels
+    with torch.inference_mode():
+        generated_ids = model.generate(
+            pixel_values,
+            max_new_tokens=TROCR_MAX_NEW_TOKENS,
+            num_beams=1,
+            do_sample=False,
+            use_cache=True,
+            pad_token_id=processor.tokenizer.pad_token_id
+        )
 
     # Batch decode
-    texts = processor.batch_decode(
+    return processor.batch_decode(
         generated_ids,
         skip_special_tokens=True,
         clean_up_tokenization_spaces=True
     )
 
+
+def recognize_text_with_trocr(image_rgb, text_box_list):
+    """
+    Recognize the text inside each box.
+    Boxes EasyOCR already read with confidence >= EASYOCR_CONF_THRESHOLD keep
+    EasyOCR's text; only the rest go through the (much slower) TrOCR pass.
+    """
+    valid_boxes = [box for box in text_box_list if box['w'] > 0 and box['h'] > 0]
+    if not valid_boxes:
+        return []
+
+    texts = [
+        box.get('text') if box.get('conf', 0.0) >= EASYOCR_CONF_THRESHOLD else None
+        for box in valid_boxes
+    ]
+
+    # Batch all low-confidence boxes through TrOCR
+    pending = [i for i, txt in enumerate(texts) if txt is None]
+    if pending:
+        trocr_texts = _trocr_read_boxes(image_rgb, [valid_boxes[i] for i in pending])
+        if trocr_texts is None:
+            # Without TrOCR, fall back to EasyOCR's low-confidence reading
+            trocr_texts = [valid_boxes[i].get('text') for i in pending]
+        for i, txt in zip(pending, trocr_texts):
+            texts[i] = txt
+
     # Return in original format
     recognized_text = []
     for box, txt in zip(valid_boxes, texts):
+        if txt is None:
+            continue
         recognized_text.append({
             'text': txt,
             'bbox': {
@@ -197,14 +304,56 @@ def recognize_text_with_trocr(image_path, text_box_list):
     return recognized_text
 
 
-def detect_boxes_and_text(image_path):
-    # Main function to detect both boxes and text and save the information as JSON.
+def remove_duplicate_boxes(boxes, iou_threshold=0.8):
+    """
+    Greedy non-maximum suppression: walk the boxes from the largest contour
+    area down and drop any box whose IoU with an already kept box exceeds
+    iou_threshold. IoU against all remaining boxes is computed in one NumPy pass.
+    Returns the kept boxes as {'x', 'y', 'w', 'h'} dicts (without 'area').
+    """
+    if not boxes:
+        return []
+
+    order = np.argsort([-b['area'] for b in boxes], kind="stable")
+    rects = np.array([[b['x'], b['y'], b['x'] + b['w'], b['y'] + b['h']] for b in boxes],
+                     dtype=np.int64)[order]
+    rect_areas = (rects[:, 2] - rects[:, 0]) * (rects[:, 3] - rects[:, 1])
+
+    keep = []
+    remaining = np.arange(len(rects))
+    while remaining.size:
+        i = remaining[0]
+        keep.append(i)
+        rest = remaining[1:]
+
+        inter_w = np.maximum(0, np.minimum(rects[i, 2], rects[rest, 2]) - np.maximum(rects[i, 0], rects[rest, 0]))
+        inter_h = np.maximum(0, np.minimum(rects[i, 3], rects[rest, 3]) - np.maximum(rects[i, 1], rects[rest, 1]))
+        inter_area = inter_w * inter_h
+        union_area = (rect_areas[i] + rect_areas[rest] - inter_area).astype(np.float64)
+        iou = np.divide(inter_area, union_area, out=np.zeros_like(union_area), where=union_area > 0)
+
+        remaining = rest[iou <= iou_threshold]
+
+    return [
+        {k: boxes[order[i]][k] for k in ('x', 'y', 'w', 'h')}
+        for i in keep
+    ]
+
+
+def run_detection(image_path):
+    """
+    Run the OpenCV + EasyOCR + TrOCR detection on one image in this process.
+    Returns (data, complete):
+      - data: {"image_path", "ui_boxes", "text_labels"}, or None if the image can't be read
+      - complete: False if an OCR model was unavailable, so the text results are
+        degraded (empty, or EasyOCR's low-confidence guesses) and shouldn't be cached
+    """
     # Ensure image_path is a string for OpenCV
     image_path = str(image_path)
     image = cv2.imread(image_path)
     if image is None:
         print("Error: Could not read image.")
-        return [], []
+        return None, False
 
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
@@ -212,81 +361,163 @@ def detect_boxes_and_text(image_path):
     blurred = cv2.GaussianBlur(gray, (5, 5), 0)
     thresh = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
                                    cv2.THRESH_BINARY_INV, 11, 2)
-    kernel = np.ones((11, 11), np.uint8)
-    closing = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
+    closing = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, CLOSE_KERNEL)
     
-    contours, hierarchy = cv2.findContours(closing, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    if hierarchy is not None:
-        hierarchy = hierarchy[0]
+    contours, _ = cv2.findContours(closing, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+
+    # Cheap checks (area, size, aspect ratio) for all contours at once, so the
+    # polygon approximation and convex hull only run on the few that survive
+    areas = np.fromiter((cv2.contourArea(c) for c in contours), dtype=np.float64, count=len(contours))
+    rects = np.array([cv2.boundingRect(c) for c in contours], dtype=np.int64).reshape(-1, 4)
+    size_ok = (areas > 1200) & (rects[:, 2] > 50) & (rects[:, 3] > 50)
+    aspect_ratio = np.divide(rects[:, 2], rects[:, 3], out=np.zeros(len(rects)), where=size_ok)
+    candidates = np.flatnonzero(size_ok & (aspect_ratio > 0.1) & (aspect_ratio < 10.0))
 
     potential_boxes = []
-    for i, contour in enumerate(contours):
+    for i in candidates:
+        contour = contours[i]
         perimeter = cv2.arcLength(contour, True)
         approx = cv2.approxPolyDP(contour, 0.04 * perimeter, True)
-        area = cv2.contourArea(contour)
-        x, y, w, h = cv2.boundingRect(contour)
-
-        if len(approx) >= 4 and len(approx) <= 8 and area > 1200:
-            aspect_ratio = float(w) / h
-            if 0.1 < aspect_ratio < 10.0:
-                hull = cv2.convexHull(contour)
-                hull_area = cv2.contourArea(hull)
-                if hull_area > 0:
-                    solidity = float(area) / hull_area
-                    if solidity > 0.70 and w > 50 and h > 50:
-                        parent_idx = hierarchy[i][3] if hierarchy is not None else -1
-                        potential_boxes.append({
-                            'x': x, 'y': y, 'w': w, 'h': h,
-                            'area': area 
-                        })
+        if not 4 <= len(approx) <= 8:
+            continue
+
+        hull = cv2.convexHull(contour)
+        hull_area = cv2.contourArea(hull)
+        if hull_area > 0:
+            solidity = float(areas[i]) / hull_area
+            if solidity > 0.70:
+                x, y, w, h = (int(v) for v in rects[i])
+                potential_boxes.append({
+                    'x': x, 'y': y, 'w': w, 'h': h,
+                    'area': float(areas[i])
+                })
 
     # Remove duplicates (IoU > 0.8)
-    final_boxes = []
-    potential_boxes.sort(key=lambda b: b['area'], reverse=True)
-    for box in potential_boxes:
-        is_duplicate = False
-        for final_box in final_boxes:
-            x_a = max(box['x'], final_box['x'])
-            y_a = max(box['y'], final_box['y'])
-            x_b = min(box['x'] + box['w'], final_box['x'] + final_box['w'])
-            y_b = min(box['y'] + box['h'], final_box['y'] + final_box['h'])
-            inter_area = max(0, x_b - x_a) * max(0, y_b - y_a)
-            box_a_area = box['w'] * box['h']
-            box_b_area = final_box['w'] * final_box['h']
-            union_area = float(box_a_area + box_b_area - inter_area)
-            if union_area > 0 and inter_area / union_area > 0.8:
-                is_duplicate = True
-                break
-        if not is_duplicate:
-            final_boxes.append(box)
-
-    # Strip _area before saving
-    for box in final_boxes:
-        if 'area' in box:
-            del box['area']
-
-    # Step 2: Detect text boxes and recognize text
-    detected_text_boxes = detect_text_boxes_easyocr(image_path)
-    detected_text_labels = recognize_text_with_trocr(image_path, detected_text_boxes)
-
-    # Step 3: Save to JSON file
+    final_boxes = remove_duplicate_boxes(potential_boxes, iou_threshold=0.8)
+
+    # Step 2: Detect text boxes and recognize text (reusing the decoded image)
+    image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    detected_text_boxes = detect_text_boxes_easyocr(image_rgb)
+    complete = detected_text_boxes is not None
+    detected_text_boxes = detected_text_boxes or []
+    detected_text_labels = recognize_text_with_trocr(image_rgb, detected_text_boxes)
+
+    # Low-confidence boxes needed TrOCR, but it could not be loaded
+    if trocr_model is None and any(
+        box['w'] > 0 and box['h'] > 0 and box.get('conf', 0.0) < EASYOCR_CONF_THRESHOLD
+        for box in detected_text_boxes
+    ):
+        complete = False
+
     data = {
         "image_path": image_path,
         "ui_boxes": final_boxes,
         "text_labels": detected_text_labels
     }
+    return data, complete
+
 
+def _trocr_backend():
+    # The TrOCR backend get_trocr_model() will pick on this machine
+    if torch.cuda.is_available():
+        return "cuda-fp16"
+    if importlib.util.find_spec("optimum") and importlib.util.find_spec("onnxruntime"):
+        return "onnx-int8"
+    return "cpu-fp32"
+
+
+# Everything besides the image that affects the OCR output; part of the cache key,
+# so changing a setting (or the backend) doesn't serve stale results
+OCR_CACHE_TAG = "|".join([
+    f"v{OCR_CACHE_VERSION}",
+    TROCR_MODEL_NAME,
+    f"conf={EASYOCR_CONF_THRESHOLD}",
+    f"tokens={TROCR_MAX_NEW_TOKENS}",
+    _trocr_backend(),
+]).encode("utf-8")
+
+
+def _ocr_cache_file(image_path):
+    """
+    Cache file for the detection results of this exact image (by content hash)
+    under the current OCR settings (OCR_CACHE_TAG).
+    Returns None if the image can't be read.
+    """
     try:
-        output_path = RAW_WIREFRAME_JSON
-        with open(output_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-    except Exception as e:
-        print(f"Error writing JSON: {e}")
+        with open(image_path, "rb") as f:
+            h = hashlib.blake2b(OCR_CACHE_TAG, digest_size=16)
+            h.update(b"\0")
+            h.update(f.read())
+            digest = h.hexdigest()
+    except OSError:
+        return None
+    return OCR_CACHE_DIR / f"{digest}.json"
+
+
+def _models_loaded():
+    # True once this process has loaded (at least one of) the OCR models
+    return _easyocr_reader is not None or trocr_model is not None
+
+
+def detect_boxes_and_text(image_path, save_to_disk=True, start_ocr_service=False):
+    # Main function to detect both boxes and text.
+    # Returns the detection data (None on failure); also saved as JSON if save_to_disk.
+    # start_ocr_service: if no OCR service is running, launch one (see ocr_service.py)
+    # and use it, instead of loading the models in this process.
+    image_path = str(image_path)
 
-    return "--- Detection Completed ---"
+    # Same image processed before: reuse its results
+    data = None
+    cache_file = _ocr_cache_file(image_path)
+    if cache_file is not None and cache_file.is_file():
+        try:
+            data = orjson.loads(cache_file.read_bytes())
+            data["image_path"] = image_path
+            print("Using cached OCR results.")
+        except Exception as e:
+            print(f"Error reading OCR cache: {e}")
+            data = None
+
+    if data is None:
+        # Models already loaded here (e.g. after stc_init()): run in this process.
+        # Otherwise prefer a running OCR service, which has them loaded.
+        result = None
+        if not _models_loaded():
+            result = request_detection(image_path)
+            if result is None and start_ocr_service and start_service():
+                result = request_detection(image_path)
+        if result is None:
+            result = run_detection(image_path)
+        data, complete = result
+        if data is None:
+            return None
+
+        # Results from a run without all OCR models are not cached
+        if not complete:
+            print("OCR ran without all models; results will not be cached.")
+        elif cache_file is not None:
+            try:
+                OCR_CACHE_DIR.mkdir(exist_ok=True)
+                tmp_file = cache_file.with_suffix(".tmp")
+                tmp_file.write_bytes(orjson.dumps(data))
+                os.replace(tmp_file, cache_file)
+            except Exception as e:
+                print(f"Error writing OCR cache: {e}")
+
+    # Save to JSON file
+    if save_to_disk:
+        try:
+            output_path = RAW_WIREFRAME_JSON
+            data_bytes = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+            with open(output_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+                f.write(data_bytes)
+        except Exception as e:
+            print(f"Error writing JSON: {e}")
+
+    return data
 
 # Script entry point
 if __name__ == "__main__":
     initialize_models()
-    status = detect_boxes_and_text(str(FILES_DIR / "sample.jpg"))
-    print(status)
+    if detect_boxes_and_text(str(FILES_DIR / "sample.jpg")) is not None:
+        print("--- Detection Completed ---")
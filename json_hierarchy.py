@@ -1,9 +1,16 @@
 # take the raw_wireframe.json (output of stage 1 - image-to-json.py)
 # output a hierarchially structured, LLM-facing json (ir.json)
 
-import json
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+import orjson
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional (faster parent search on large wireframes)
+    njit = None
 
 from .paths import RAW_WIREFRAME_JSON, HIERARCHY_WIREFRAME_JSON
 
@@ -26,12 +33,24 @@ def rect_contains(outer: Dict[str, float], inner: Dict[str, float], tol: float =
 
 def rect_union(rects: List[Dict[str, float]]) -> Dict[str, float]:
     """
-    Minimal rect that contains all rects.
+    Minimal rect that contains all rects (single pass over the list).
     """
-    min_x = min(r["x"] for r in rects)
-    min_y = min(r["y"] for r in rects)
-    max_x = max(r["x"] + r["w"] for r in rects)
-    max_y = max(r["y"] + r["h"] for r in rects)
+    first = rects[0]
+    min_x, min_y = first["x"], first["y"]
+    max_x, max_y = min_x + first["w"], min_y + first["h"]
+
+    for r in rects:
+        x, y = r["x"], r["y"]
+        x1, y1 = x + r["w"], y + r["h"]
+        if x < min_x:
+            min_x = x
+        if y < min_y:
+            min_y = y
+        if x1 > max_x:
+            max_x = x1
+        if y1 > max_y:
+            max_y = y1
+
     return {"x": min_x, "y": min_y, "w": max_x - min_x, "h": max_y - min_y}
 
 
@@ -44,41 +63,40 @@ def build_nodes(data: Dict[str, Any]) -> Dict[str, Any]:
     Build nodes (ui + text) + outer box from raw JSON.
     Returns dict with "image_path" and "nodes" (including outer).
     """
-    nodes: List[Dict[str, Any]] = []
-
     # UI boxes
-    for i, box in enumerate(data.get("ui_boxes", [])):
-        nodes.append(
-            {
-                "id": f"ui_{i}",
-                "kind": "ui",  # UI box
-                "abs": {
-                    "x": float(box["x"]),
-                    "y": float(box["y"]),
-                    "w": float(box["w"]),
-                    "h": float(box["h"]),
-                },
-                "children": [],
-            }
-        )
+    ui_nodes: List[Dict[str, Any]] = [
+        {
+            "id": f"ui_{i}",
+            "kind": "ui",  # UI box
+            "abs": {
+                "x": float(box["x"]),
+                "y": float(box["y"]),
+                "w": float(box["w"]),
+                "h": float(box["h"]),
+            },
+            "children": [],
+        }
+        for i, box in enumerate(data.get("ui_boxes", []))
+    ]
 
     # Text boxes
-    for i, label in enumerate(data.get("text_labels", [])):
-        bbox = label["bbox"]
-        nodes.append(
-            {
-                "id": f"text_{i}",
-                "kind": "text",
-                "text": label["text"],
-                "abs": {
-                    "x": float(bbox["x"]),
-                    "y": float(bbox["y"]),
-                    "w": float(bbox["w"]),
-                    "h": float(bbox["h"]),
-                },
-                "children": [],
-            }
-        )
+    text_nodes: List[Dict[str, Any]] = [
+        {
+            "id": f"text_{i}",
+            "kind": "text",
+            "text": label["text"],
+            "abs": {
+                "x": float(label["bbox"]["x"]),
+                "y": float(label["bbox"]["y"]),
+                "w": float(label["bbox"]["w"]),
+                "h": float(label["bbox"]["h"]),
+            },
+            "children": [],
+        }
+        for i, label in enumerate(data.get("text_labels", []))
+    ]
+
+    nodes = ui_nodes + text_nodes
 
     if not nodes:
         raise ValueError("No ui_boxes or text_labels found")
@@ -100,6 +118,46 @@ def build_nodes(data: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 
+def _find_parents_loop(x0s, y0s, x1s, y1s, larger_start):
+    """
+    For rects sorted by area (ascending), return the position of each rect's
+    smallest containing rect among the strictly larger ones (-1 if none).
+    Plain loops, meant to be compiled with numba.
+    """
+    n = x0s.shape[0]
+    parents = np.full(n, -1, np.int64)
+    for i in range(n):
+        for j in range(larger_start[i], n):
+            if x0s[j] <= x0s[i] and y0s[j] <= y0s[i] and x1s[j] >= x1s[i] and y1s[j] >= y1s[i]:
+                parents[i] = j
+                break
+    return parents
+
+
+def _find_parents_numpy(x0s, y0s, x1s, y1s, larger_start):
+    """
+    Same as _find_parents_loop(), checking all larger rects of a node at once.
+    """
+    n = x0s.shape[0]
+    parents = np.full(n, -1, np.int64)
+    for i in range(n):
+        s = larger_start[i]
+        is_parent = (
+            (x0s[s:] <= x0s[i])
+            & (y0s[s:] <= y0s[i])
+            & (x1s[s:] >= x1s[i])
+            & (y1s[s:] >= y1s[i])
+        )
+        # Candidates are sorted by area, so the first hit is the smallest parent
+        # (first in node order on ties)
+        if is_parent.any():
+            parents[i] = s + int(is_parent.argmax())
+    return parents
+
+
+_find_parents = njit(cache=True)(_find_parents_loop) if njit else _find_parents_numpy
+
+
 def build_hierarchy(nodes_info: Dict[str, Any]) -> Dict[str, Any]:
     """
     Given dict from build_nodes(), build parent-child hierarchy by containment.
@@ -108,191 +166,165 @@ def build_hierarchy(nodes_info: Dict[str, Any]) -> Dict[str, Any]:
     image_path = nodes_info["image_path"]
     all_nodes: List[Dict[str, Any]] = nodes_info["nodes"]
 
-    # Find outer
-    outer = next(n for n in all_nodes if n["kind"] == "outer")
-    outer_area = rect_area(outer["abs"])
+    # Outer (build_nodes() always puts it first)
+    outer = all_nodes[0]
 
-    other_nodes = [n for n in all_nodes if n is not outer]
+    # Read every rect out of its dict once, into parallel arrays (one entry per node)
+    rects = np.array(
+        [
+            (r["x"], r["y"], r["x"] + r["w"], r["y"] + r["h"], rect_area(r))
+            for r in (n["abs"] for n in all_nodes)
+        ],
+        dtype=np.float64,
+    )
 
     # Sort by area: smallest first (so we attach tight parents)
-    other_nodes_sorted = sorted(other_nodes, key=lambda n: rect_area(n["abs"]))
-
-    # Build a lookup for convenience
-    id_to_node = {n["id"]: n for n in all_nodes}
+    order = np.argsort(rects[:, 4], kind="stable")
+    x0s, y0s, x1s, y1s, areas = np.ascontiguousarray(rects[order].T)
 
-    for node in other_nodes_sorted:
-        node_rect = node["abs"]
-        best_parent = outer
-        best_parent_area = outer_area
+    # Parent must be strictly larger, so only the nodes from larger_start[i]
+    # onwards can be parents of the i-th smallest node
+    larger_start = np.searchsorted(areas, areas, side="right")
 
-        for cand in all_nodes:
-            if cand is node:
-                continue
+    parents = _find_parents(x0s, y0s, x1s, y1s, larger_start)
 
-            cand_rect = cand["abs"]
-            area_cand = rect_area(cand_rect)
+    for i, row in enumerate(order):
+        node = all_nodes[row]
+        if node is outer:
+            continue
 
-            # parent must be larger and must contain the node
-            if area_cand > rect_area(node_rect) and rect_contains(cand_rect, node_rect):
-                if area_cand < best_parent_area:
-                    best_parent_area = area_cand
-                    best_parent = cand
+        # Smallest containing node, else outer
+        best_parent = outer
+        if parents[i] >= 0:
+            best_parent = all_nodes[order[parents[i]]]
 
         # Attach node to its best parent
-        node["_parent_id"] = best_parent["id"]
         best_parent["children"].append(node)
 
     return {
         "image_path": image_path,
         "root": outer,
-        "id_to_node": id_to_node,
     }
 
 
-def add_relative_geometry(tree: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    Recursively add:
-      - margins (px + relative) to each node, relative to its parent
-      - size_rel (relative width/height to parent)
-      - font_size_rel_outer for text nodes (relative to OUTER box height)
-    Returns same structure with enriched nodes.
-    """
-    root = tree["root"]
-    outer_rect = root["abs"]
-
-    def _recurse(node: Dict[str, Any], parent_abs: Dict[str, float]):
-        rect = node["abs"]
-
-        if node["kind"] == "outer":
-            # Outer: margins = 0, size_rel = 1
-            node["margins"] = {
-                "top": 0.0,
-                "left": 0.0,
-                "right": 0.0,
-                "bottom": 0.0,
-                "top_rel": 0.0,
-                "left_rel": 0.0,
-                "right_rel": 0.0,
-                "bottom_rel": 0.0,
-            }
-            node["size_rel"] = {"w_rel": 1.0, "h_rel": 1.0}
-        else:
-            px = parent_abs["x"]
-            py = parent_abs["y"]
-            pw = parent_abs["w"]
-            ph = parent_abs["h"]
-
-            x, y, w, h = rect["x"], rect["y"], rect["w"], rect["h"]
-
-            m_left = x - px
-            m_top = y - py
-            m_right = (px + pw) - (x + w)
-            m_bottom = (py + ph) - (y + h)
-
-            node["margins"] = {
-                "top": m_top,
-                "left": m_left,
-                "right": m_right,
-                "bottom": m_bottom,
-                "top_rel": m_top / ph if ph else 0.0,
-                "left_rel": m_left / pw if pw else 0.0,
-                "right_rel": m_right / pw if pw else 0.0,
-                "bottom_rel": m_bottom / ph if ph else 0.0,
-            }
-
-            node["size_rel"] = {
-                "w_rel": w / pw if pw else 0.0,
-                "h_rel": h / ph if ph else 0.0,
-            }
-
-        # Font size: relative to OUTER box height
-        if node["kind"] == "text":
-            node["font_size_rel_outer"] = (
-                rect["h"] / outer_rect["h"] if outer_rect["h"] else 0.0
-            )
-
-        for child in node.get("children", []):
-            _recurse(child, rect)
-
-    _recurse(root, root["abs"])
-    return tree
-
-
-def _round4(x: float) -> float:
-    return float(f"{x:.4f}")
-
-
-def simplify_node_for_llm(node: Dict[str, Any]) -> Dict[str, Any]:
+def build_llm_tree(root: Dict[str, Any], outer_h: float) -> Dict[str, Any]:
     """
-    Take a rich node (with abs, margins, size_rel, etc.)
-    and return a compact, LLM-friendly representation:
+    Take the hierarchy root (outer node with abs rects and children)
+    and return a compact, LLM-friendly tree
+    (relative geometry is computed with NumPy for all nodes at once):
       - id
       - type: "root" | "box" | "text"
-      - text (only for text nodes)
-      - layout: {top, left, right, bottom, width, height} (all relative)
-      - font: {size_rel_outer} for text
-      - children: simplified children
+      - layout: {top, left, right, bottom, width, height}
+        (margins and size relative to the parent, rounded to 4 digits)
+      - text + font: {size_rel_outer} for text nodes (relative to OUTER box height)
+      - children: same structure
     """
-    kind = node["kind"]
-    if kind == "outer":
-        node_type = "root"
-    elif kind == "ui":
-        node_type = "box"
-    else:
-        node_type = "text"
-
-    margins = node["margins"]
-    size_rel = node["size_rel"]
-
-    layout = {
-        "top": _round4(margins["top_rel"]),
-        "left": _round4(margins["left_rel"]),
-        "right": _round4(margins["right_rel"]),
-        "bottom": _round4(margins["bottom_rel"]),
-        "width": _round4(size_rel["w_rel"]),
-        "height": _round4(size_rel["h_rel"]),
+    simple_root: Dict[str, Any] = {
+        "id": root["id"],
+        "type": "root",
+        # Outer: margins = 0, size_rel = 1
+        "layout": {
+            "top": 0.0,
+            "left": 0.0,
+            "right": 0.0,
+            "bottom": 0.0,
+            "width": 1.0,
+            "height": 1.0,
+        },
+        "children": [],
     }
 
-    simple: Dict[str, Any] = {
-        "id": node["id"],
-        "type": node_type,
-        "layout": layout,
-        "children": [simplify_node_for_llm(ch) for ch in node.get("children", [])],
-    }
+    # Collect the nodes parents-first with an explicit stack (no recursion, so
+    # deep trees don't hit the recursion limit), remembering each node's parent
+    # position in the list (-1 = root); siblings stay in order
+    nodes: List[Dict[str, Any]] = []
+    parent_idx: List[int] = []
+    stack = [(root, -1)]
+    while stack:
+        parent, p = stack.pop()
+        for node in parent.get("children", []):
+            parent_idx.append(p)
+            stack.append((node, len(nodes)))
+            nodes.append(node)
 
-    if kind == "text":
-        simple["text"] = node.get("text", "")
-        simple["font"] = {
-            "size_rel_outer": _round4(node.get("font_size_rel_outer", 0.0))
+    if not nodes:
+        return simple_root
+
+    # All node rects + their parents' rects as arrays (row 0 is the root)
+    rects = np.array(
+        [(r["x"], r["y"], r["w"], r["h"]) for r in [root["abs"]] + [n["abs"] for n in nodes]],
+        dtype=np.float64,
+    )
+    x, y, w, h = rects[1:].T
+    px, py, pw, ph = rects[np.array(parent_idx) + 1].T
+
+    # Multiply by reciprocals (0 for zero-sized parents) instead of dividing
+    inv_pw = np.divide(1.0, pw, out=np.zeros_like(pw), where=pw != 0)
+    inv_ph = np.divide(1.0, ph, out=np.zeros_like(ph), where=ph != 0)
+    inv_outer_h = 1.0 / outer_h if outer_h else 0.0
+
+    # Relative geometry of every node at once, one row per node
+    geometry = np.round(
+        np.column_stack(
+            (
+                (y - py) * inv_ph,  # top
+                (x - px) * inv_pw,  # left
+                ((px + pw) - (x + w)) * inv_pw,  # right
+                ((py + ph) - (y + h)) * inv_ph,  # bottom
+                w * inv_pw,  # width
+                h * inv_ph,  # height
+                h * inv_outer_h,  # font size, relative to OUTER box height
+            )
+        ),
+        4,
+    ).tolist()
+
+    # Build the simplified nodes; parents come first, so they already exist
+    simples: List[Dict[str, Any]] = []
+    for node, p, (top, left, right, bottom, width, height, font_size) in zip(nodes, parent_idx, geometry):
+        simple: Dict[str, Any] = {
+            "id": node["id"],
+            "type": "box" if node["kind"] == "ui" else "text",
+            "layout": {
+                "top": top,
+                "left": left,
+                "right": right,
+                "bottom": bottom,
+                "width": width,
+                "height": height,
+            },
+            "children": [],
         }
 
-    return simple
+        if node["kind"] == "text":
+            simple["text"] = node.get("text", "")
+            simple["font"] = {"size_rel_outer": font_size}
+
+        (simples[p] if p >= 0 else simple_root)["children"].append(simple)
+        simples.append(simple)
 
+    return simple_root
 
-def process_wireframe_json():
+
+def process_wireframe_json(data: Optional[Dict[str, Any]] = None, save_to_disk: bool = True) -> Dict[str, Any]:
     """
     Full pipeline:
-      - read JSON
+      - read JSON (unless the detection data is passed in directly)
       - detect outer box
       - build hierarchy
-      - convert to relative margins/size
-      - simplify to an LLM-facing layout tree
+      - convert to relative margins/size + simplify to an LLM-facing layout tree
       - (optional) write result to another json file
+    Returns the LLM-facing result ({"image_path", "layout"}).
     """
-    input_filepath = RAW_WIREFRAME_JSON
-    with input_filepath.open("r", encoding="utf-8") as f:
-        data = json.load(f)
+    if data is None:
+        input_filepath = RAW_WIREFRAME_JSON
+        data = orjson.loads(input_filepath.read_bytes())
 
     nodes_info = build_nodes(data)
     tree = build_hierarchy(nodes_info)
-    tree = add_relative_geometry(tree)
-
-    id_to_node = tree.pop("id_to_node")
-    for node in id_to_node.values():
-        node.pop("_parent_id", None)
 
-    # LLM-facing tree
-    layout_root = simplify_node_for_llm(tree["root"])
+    # LLM-facing tree (relative geometry is computed while simplifying)
+    layout_root = build_llm_tree(tree["root"], tree["root"]["abs"]["h"])
 
     result = {
         "image_path": tree["image_path"],
@@ -300,14 +332,14 @@ def process_wireframe_json():
     }
 
     # Write the json file to disk for generating the code
-    save_to = HIERARCHY_WIREFRAME_JSON
-    with save_to.open("w", encoding="utf-8") as f:
-        json.dump(result, f, indent=2)
+    if save_to_disk:
+        save_to = HIERARCHY_WIREFRAME_JSON
+        save_to.write_bytes(orjson.dumps(result, option=orjson.OPT_INDENT_2))
 
-    return "Hierarchy generated successfully!"
+    return result
 
 
 # Script entry point
 if __name__ == "__main__":
-    status = process_wireframe_json()
-    print(status)
+    process_wireframe_json()
+    print("Hierarchy generated successfully!")
@@ -0,0 +1,202 @@
+"""
+Background OCR service for SketchToCode.
+
+Loading the EasyOCR + TrOCR models takes several seconds on every run. The service
+loads them once and answers detection requests over a local socket (a named pipe
+on Windows), so repeated runs skip the model load. It is opt-in: start it yourself,
+or pass start_ocr_service=True to image_to_json.detect_boxes_and_text(). It exits
+on its own after OCR_SERVICE_IDLE_TIMEOUT seconds without requests.
+
+- serve(): run the service (this is what `python -m <package>.ocr_service` does)
+- request_detection(image_path): ask a running service; None if there is none
+- start_service(): launch the service as a detached background process
+"""
+
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+
+from .paths import OCR_SERVICE_ADDRESS, OCR_SERVICE_KEY_FILE
+
+# Seconds a client waits for a detection result before giving up on the service
+OCR_SERVICE_TIMEOUT = 120
+# Seconds start_service() waits for a freshly launched service to load its models
+OCR_SERVICE_START_TIMEOUT = 180
+# Seconds without requests after which the service exits (0 = never)
+OCR_SERVICE_IDLE_TIMEOUT = 30 * 60
+
+# Only try to launch the service once per process
+_service_started = False
+
+
+def _read_authkey():
+    try:
+        return OCR_SERVICE_KEY_FILE.read_bytes()
+    except OSError:
+        return None
+
+
+def request_detection(image_path):
+    """
+    Ask a running OCR service to process the image.
+    Returns the same (data, complete) pair as image_to_json.run_detection(),
+    or None if no service answered.
+    """
+    authkey = _read_authkey()
+    if not authkey:
+        return None
+
+    try:
+        with Client(OCR_SERVICE_ADDRESS, authkey=authkey) as conn:
+            # The service has its own working directory
+            conn.send(os.path.abspath(image_path))
+            if not conn.poll(OCR_SERVICE_TIMEOUT):
+                print(f"OCR service did not answer within {OCR_SERVICE_TIMEOUT}s.")
+                return None
+            data, complete = conn.recv()
+    except (OSError, EOFError, AuthenticationError, TypeError, ValueError):
+        # No service, or a reply we don't understand (e.g. from an older service)
+        return None
+
+    if data is not None:
+        data["image_path"] = str(image_path)
+    return data, complete
+
+
+def is_running() -> bool:
+    authkey = _read_authkey()
+    if not authkey:
+        return False
+
+    try:
+        Client(OCR_SERVICE_ADDRESS, authkey=authkey).close()
+        return True
+    except (OSError, EOFError, AuthenticationError):
+        return False
+
+
+def start_service(wait_timeout: float = OCR_SERVICE_START_TIMEOUT) -> bool:
+    """
+    Launch the OCR service in the background, so later runs find the models loaded,
+    and wait (up to wait_timeout seconds) until it accepts requests.
+    Returns True if the service is running.
+    """
+    global _service_started
+    if not _service_started:
+        _service_started = True
+        try:
+            subprocess.Popen(
+                [sys.executable, "-m", f"{__package__}.ocr_service"],
+                cwd=str(Path(__file__).resolve().parent.parent),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+            print("Started background OCR service (later runs will reuse its loaded models).")
+        except Exception as e:
+            print(f"Failed to start OCR service: {e}")
+            return False
+
+    deadline = time.monotonic() + wait_timeout
+    while not is_running():
+        if time.monotonic() >= deadline:
+            print("OCR service did not come up in time.")
+            return False
+        time.sleep(0.5)
+    return True
+
+
+def _remove_service_files(address):
+    try:
+        OCR_SERVICE_KEY_FILE.unlink()
+    except OSError:
+        pass
+    if sys.platform != "win32":
+        try:
+            os.unlink(address)
+        except OSError:
+            pass
+
+
+def serve(address=OCR_SERVICE_ADDRESS, idle_timeout=OCR_SERVICE_IDLE_TIMEOUT):
+    """
+    Load the OCR models once and answer detection requests until interrupted,
+    or until no request came in for idle_timeout seconds.
+    """
+    from .image_to_json import initialize_models, run_detection
+
+    if is_running():
+        print("OCR service is already running.")
+        return
+
+    # Leftover socket from a service that did not shut down cleanly
+    if sys.platform != "win32" and os.path.exists(address):
+        os.unlink(address)
+
+    initialize_models()
+
+    # One detection at a time (shared models); the accept loop stays free, so
+    # clients never wait on the handshake while a detection runs
+    detection_lock = threading.Lock()
+    last_request_at = time.monotonic()
+
+    def _handle(conn):
+        nonlocal last_request_at
+        with conn:
+            try:
+                image_path = conn.recv()
+                with detection_lock:
+                    try:
+                        result = run_detection(image_path)
+                    finally:
+                        last_request_at = time.monotonic()
+                conn.send(result)
+            except (OSError, EOFError):
+                # Client went away (or is_running() probe)
+                pass
+            except Exception as e:
+                print(f"OCR service: request failed: {e}")
+
+    def _exit_when_idle():
+        while True:
+            time.sleep(min(idle_timeout, 60))
+            with detection_lock:
+                if time.monotonic() - last_request_at >= idle_timeout:
+                    print("OCR service: idle, shutting down.")
+                    _remove_service_files(address)
+                    os._exit(0)
+
+    if idle_timeout:
+        threading.Thread(target=_exit_when_idle, daemon=True).start()
+
+    # Fresh key per service run, readable only by the current user
+    authkey = secrets.token_bytes(32)
+    try:
+        with Listener(address, authkey=authkey) as listener:
+            if sys.platform != "win32":
+                os.chmod(address, 0o600)
+            fd = os.open(OCR_SERVICE_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                f.write(authkey)
+
+            print(f"OCR service listening on {address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError, AuthenticationError):
+                    continue
+                threading.Thread(target=_handle, args=(conn,), daemon=True).start()
+    finally:
+        _remove_service_files(address)
+
+
+# Script entry point
+if __name__ == "__main__":
+    serve()
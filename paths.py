@@ -1,3 +1,6 @@
+import os
+import sys
+import tempfile
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent
@@ -14,5 +17,24 @@ HIERARCHY_WIREFRAME_JSON = FILES_DIR / "hierarchy_wireframe.json"
 OUTPUT_HTML = FILES_DIR / "index.html"
 DEFAULT_HTML_FILE = str(FILES_DIR / "index.html")
 
+# Buffer size for output files (written with a single encoded write)
+WRITE_BUFFER_SIZE = 1 << 18
+
+# TrOCR exported to ONNX + int8 (only used when optimum[onnxruntime] is installed)
+TROCR_ONNX_DIR = FILES_DIR / ".onnxcache" / "trocr-base-handwritten-int8"
+
+# Background OCR service (see ocr_service.py): socket / named pipe + auth key file
+if sys.platform == "win32":
+    OCR_SERVICE_ADDRESS = r"\\.\pipe\sketchtocode-ocr"
+else:
+    OCR_SERVICE_ADDRESS = str(Path(tempfile.gettempdir()) / f"sketchtocode-ocr-{os.getuid()}.sock")
+OCR_SERVICE_KEY_FILE = FILES_DIR / ".ocr_service_key"
+
+# On-disk cache of OCR results, keyed by a hash of the image bytes
+OCR_CACHE_DIR = FILES_DIR / ".ocrcache"
+
+# On-disk cache of Gemini responses, keyed by a hash of (model, prompt, input)
+LLM_CACHE_DIR = FILES_DIR / ".llmcache"
+
 API_KEY_FILE = BASE_DIR / "gemini_key.txt" # TODO: use a different method to pass in the API key, this is not secure
 DEFAULT_MODEL = "gemini-2.5-flash"
@@ -1,14 +1,16 @@
 # main file responsible for running the pipeline step by step
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable, Optional
 
-from .image_to_json import initialize_models, detect_boxes_and_text
-from .json_hierarchy import process_wireframe_json
-from .code_generation_gemini import generate_html, has_internet
+# The pipeline stages pull in OpenCV, torch/transformers and the Gemini SDK, so they
+# are imported inside stc_init()/stc_run(): importing this module (e.g. from the GUI)
+# stays fast, and the heavy imports happen once, on first use
+from . import ocr_service
 
 from pathlib import Path
-from .paths import FILES_DIR
+from .paths import API_KEY_FILE, FILES_DIR, OUTPUT_HTML
 
 
 def report_status(message: str, status_callback: Optional[Callable[[str], None]] = None):
@@ -20,35 +22,64 @@ def report_status(message: str, status_callback: Optional[Callable[[str], None]]
 
 def stc_init(status_callback: Optional[Callable[[str], None]] = None) -> bool:
     report_status("Initialising STC Engine", status_callback)
-    initialize_models()
+
+    from .gemini_utils import has_internet, prewarm_client
+
+    # Check internet while the models load (both mostly wait on I/O)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        online = pool.submit(has_internet)
+
+        # A running OCR service already holds the models; no need to load them here
+        if ocr_service.is_running():
+            report_status("Using running OCR service", status_callback)
+        else:
+            from .image_to_json import initialize_models
+            initialize_models()
 
     # Check internet before running the script
-    if not has_internet():
+    if not online.result():
         report_status("No internet connection. Cannot generate HTML.", status_callback)
         return False
 
+    # GUI sessions call Gemini repeatedly; open the connection up front
+    if status_callback:
+        prewarm_client(API_KEY_FILE)
+
     report_status("Initialisation complete", status_callback)
     return True
 
-def stc_run(filename: str, status_callback: Optional[Callable[[str], None]] = None) -> bool:
+# Returns the path of the generated HTML file (so callers don't have to search for it),
+# or None on failure; truthiness still tells success from failure
+def stc_run(filename: str, status_callback: Optional[Callable[[str], None]] = None) -> Optional[str]:
+    from .image_to_json import detect_boxes_and_text
+    from .json_hierarchy import process_wireframe_json
+    from .code_generation_gemini import generate_html
+
     try:
         report_status("Step 1: Detecting UI boxes and text...", status_callback)
         # ensure we pass a string path to OpenCV-based code
         img_path = str(filename) if isinstance(filename, (Path,)) else filename
-        detect_boxes_and_text(img_path)
+        # Detection results are handed to the next step in memory, not via raw_wireframe.json
+        data = detect_boxes_and_text(img_path, save_to_disk=False)
+        if data is None:
+            report_status("Error: UI box and text detection failed.", status_callback)
+            return None
 
         report_status("Step 2: Building JSON hierarchy...", status_callback)
-        process_wireframe_json()
+        # The layout tree also stays in memory instead of going through hierarchy_wireframe.json
+        tree = process_wireframe_json(data, save_to_disk=False)
 
         report_status("Step 3: Generating HTML...", status_callback)
-        generate_html()
+        if generate_html(status_callback, tree=tree) is None:
+            report_status("Error: HTML generation failed.", status_callback)
+            return None
 
         report_status("Done.", status_callback)
-        return True
+        return str(OUTPUT_HTML)
 
     except Exception as e:
         report_status(f"Error: {e}", status_callback)
-        return False
+        return None
 
 
 if __name__ == "__main__":
@@ -67,4 +98,5 @@ if __name__ == "__main__":
     if args.image == str(FILES_DIR / "sample.jpg"):
         print(f"Using test image at {str(FILES_DIR / 'sample.jpg')} because image path is not passed by the user")
 
-    stc_run(str(args.image))
+    if not stc_run(str(args.image)):
+        raise SystemExit(1)